@@ -5,8 +5,21 @@ import platform
 import traceback
 import threading
 import time
-from flask import Flask, render_template, request, jsonify
-from evm_agent import agent_loop, MCPClient, StdioServerParameters
+import math
+import uuid
+import argparse
+import multiprocessing
+import select
+import socket
+import concurrent.futures
+from contextlib import contextmanager
+from flask import Flask, render_template, request, jsonify, g
+from werkzeug.serving import make_server
+from evm_agent import agent_loop, planner_loop, MCPClient, MCPSupervisor, StdioServerParameters, SignerServiceParameters
+from signer_service import resolve_env_placeholders
+from shared_state import create_state_store
+from tool_results import tool_result_stats
+from tracing import Trace, activate, span, trace_buffer
 
 app = Flask(__name__, 
             static_folder='static',
@@ -14,12 +27,95 @@ app = Flask(__name__,
 
 # Global variables to store agent state
 mcp_client = None
+mcp_supervisor = None
 mcp_tools = None
 wallet_state = {"network": "monad-testnet"}
-conversation_history = []
+state_store = None  # Conversation sessions and tool result cache, see shared_state.py
 loop = None
 initialization_complete = False
 
+# Serving settings
+SESSION_COOKIE = "aop_session"
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH")  # SQLite file shared by worker processes
+DEFAULT_SHARED_STATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shared_state.db")
+
+# Admission control settings for /api/query
+MAX_INFLIGHT_QUERIES = int(os.getenv("MAX_INFLIGHT_QUERIES", "4"))  # Queries running in the agent loop at once
+MAX_QUEUED_QUERIES = int(os.getenv("MAX_QUEUED_QUERIES", "8"))  # Queries allowed to wait for a free slot
+MAX_QUEUE_WAIT = float(os.getenv("MAX_QUEUE_WAIT", "10"))  # Seconds a query may wait before being shed
+QUERY_TIMEOUT = float(os.getenv("QUERY_TIMEOUT", "180"))  # Seconds before a running query is cancelled
+DISCONNECT_POLL_INTERVAL = 0.5  # Seconds between client disconnect checks
+
+
+class AdmissionRejected(Exception):
+    """Raised when a query cannot be admitted and should be shed."""
+    def __init__(self, status_code: int, message: str, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounds the number of running and waiting queries."""
+    def __init__(self, max_inflight: int, max_queued: int, max_queue_wait: float):
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.max_queue_wait = max_queue_wait
+        self.inflight = 0
+        self.queued = 0
+        self.rejected = 0
+        self.shed = 0
+        self._cond = threading.Condition()
+
+    def _retry_after(self) -> int:
+        # Rough estimate: one queue wait per full batch of waiting queries
+        batches = 1 + self.queued // max(self.max_inflight, 1)
+        return max(1, math.ceil(self.max_queue_wait * batches))
+
+    @contextmanager
+    def admit(self):
+        """Hold an in-flight slot for the duration of the block."""
+        with span("admission.wait"), self._cond:
+            if self.inflight >= self.max_inflight:
+                if self.queued >= self.max_queued:
+                    self.rejected += 1
+                    raise AdmissionRejected(429, "Too many queries in progress. Please try again shortly.", self._retry_after())
+
+                self.queued += 1
+                try:
+                    deadline = time.monotonic() + self.max_queue_wait
+                    while self.inflight >= self.max_inflight:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.shed += 1
+                            raise AdmissionRejected(503, "Server is busy. Please try again shortly.", self._retry_after())
+                        self._cond.wait(remaining)
+                finally:
+                    self.queued -= 1
+            self.inflight += 1
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.inflight -= 1
+                self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "inflight": self.inflight,
+                "queued": self.queued,
+                "max_inflight": self.max_inflight,
+                "max_queued": self.max_queued,
+                "rejected": self.rejected,
+                "shed": self.shed,
+            }
+
+
+admission = AdmissionController(MAX_INFLIGHT_QUERIES, MAX_QUEUED_QUERIES, MAX_QUEUE_WAIT)
+
 async def load_mcp_config():
     """Load the MCP server configuration from mcp_config.json"""
     config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mcp_config.json")
@@ -32,7 +128,7 @@ async def load_mcp_config():
 
 async def initialize_mcp_client():
     """Initialize the MCP client and get available tools."""
-    global mcp_client, mcp_tools, initialization_complete
+    global mcp_client, mcp_supervisor, mcp_tools, initialization_complete
     
     if platform.system() == 'Windows':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
@@ -43,30 +139,30 @@ async def initialize_mcp_client():
         print("MCP config loaded successfully")
         
         # Initialize MCP client based on config
-        if "evm-signer" in config.get("mcpServers", {}):
-            server_config = config["mcpServers"]["evm-signer"]
-            
-            # Resolve environment variables in args
-            resolved_args = []
-            for arg in server_config["args"]:
-                if isinstance(arg, str) and "${" in arg:
-                    # Simple environment variable substitution
-                    for env_var in os.environ:
-                        placeholder = "${" + env_var + "}"
-                        if placeholder in arg:
-                            arg = arg.replace(placeholder, os.environ[env_var])
-                resolved_args.append(arg)
-            
-            # Create server parameters
-            server_params = StdioServerParameters(
-                command=server_config["command"],
-                args=resolved_args,
-                env=server_config.get("env")
-            )
+        service_address = os.getenv("SIGNER_SERVICE_ADDRESS")
+        if service_address or "evm-signer" in config.get("mcpServers", {}):
+            if service_address:
+                # Attach to a long-lived signer started with signer_service.py
+                server_params = SignerServiceParameters(service_address)
+            else:
+                server_config = config["mcpServers"]["evm-signer"]
+                
+                # Create server parameters, resolving environment variables in args
+                server_params = StdioServerParameters(
+                    command=server_config["command"],
+                    args=resolve_env_placeholders(server_config["args"]),
+                    env=server_config.get("env")
+                )
             
             print("Starting MCP client...")
             mcp_client = MCPClient(server_params)
-            await mcp_client.__aenter__()
+            mcp_client.cache = state_store
+            
+            # The supervisor makes the first connection, retrying with backoff while the signer
+            # is down, then keeps watching it and restarts it if it dies or hangs
+            mcp_supervisor = MCPSupervisor(mcp_client)
+            mcp_supervisor.start()
+            await mcp_client.wait_until_ready(timeout=None)
             
             # Get available tools
             print("Getting available tools...")
@@ -87,11 +183,59 @@ def run_async(coro):
     """Helper function to run async code from sync context"""
     return asyncio.run_coroutine_threadsafe(coro, loop).result()
 
+def client_disconnected(environ) -> bool:
+    """Best-effort check whether the HTTP client has closed its connection"""
+    sock = environ.get("werkzeug.socket")
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        # A readable socket with no pending data means the peer hung up
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except (OSError, ValueError):
+        return True
+
+def run_async_cancellable(coro, timeout: float, environ=None):
+    """Run async code from sync context, cancelling it on timeout or client disconnect"""
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Query timed out after {timeout:g} seconds")
+            done, _ = concurrent.futures.wait([future], timeout=min(remaining, DISCONNECT_POLL_INTERVAL))
+            if done:
+                return future.result()
+            if environ is not None and client_disconnected(environ):
+                raise ConnectionAbortedError("Client disconnected")
+    finally:
+        # Cancelling the concurrent future cancels the agent_loop task in the event loop
+        if not future.done():
+            future.cancel()
+
 def start_background_loop(loop):
     """Set event loop in the current thread and run it forever"""
     asyncio.set_event_loop(loop)
     loop.run_forever()
 
+def get_session_id() -> str:
+    """Return the caller's session id, issuing a new one if needed"""
+    session_id = request.cookies.get(SESSION_COOKIE)
+    if not session_id:
+        session_id = uuid.uuid4().hex
+        g.new_session_id = session_id
+    return session_id
+
+@app.after_request
+def set_session_cookie(response):
+    new_session_id = g.pop("new_session_id", None)
+    if new_session_id:
+        response.set_cookie(SESSION_COOKIE, new_session_id, httponly=True, samesite="Lax")
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -103,15 +247,20 @@ def get_status():
         "status": "running",
         "mcp_client_initialized": mcp_tools is not None and len(mcp_tools) > 0,
         "tools_count": len(mcp_tools) if mcp_tools else 0,
-        "initialization_complete": initialization_complete
+        "initialization_complete": initialization_complete,
+        "worker_pid": os.getpid(),
+        "admission": admission.stats(),
+        "signer": mcp_supervisor.stats() if mcp_supervisor else None,
+        "tool_results": tool_result_stats.as_dict()
     })
 
 @app.route('/api/query', methods=['POST'])
 def process_query():
-    global mcp_tools, wallet_state, conversation_history
+    global mcp_tools, wallet_state
     
     data = request.json
     query = data.get('query', '')
+    mode = data.get('mode', 'single')  # "plan" runs the multi-step planner
     
     if not query:
         return jsonify({"error": "No query provided"}), 400
@@ -129,63 +278,117 @@ def process_query():
                 "tool_calls": []
             })
     
-    # Process the query through the agent
-    try:
-        start_time = time.time()
-        
-        # Process the query asynchronously
-        async def process():
-            return await agent_loop(query, mcp_tools, wallet_state, conversation_history.copy() if conversation_history else None)
+    # Process the query through the agent, recording a trace of every stage
+    trace = Trace("query", mode=mode)
+    with activate(trace):
+        try:
+            start_time = time.time()
+            session_id = get_session_id()
+            with span("history.load") as load_span:
+                conversation_history = state_store.load_history(session_id)
+                load_span.set(messages=len(conversation_history))
             
-        # Run the agent loop in the event loop
-        response, updated_messages = run_async(process())
-        
-        processing_time = time.time() - start_time
-        print(f"Query processed in {processing_time:.2f} seconds")
-        
-        # Update conversation history
-        conversation_history = updated_messages
-        
-        # Get tool calls for display - only if they actually exist and are not empty
-        tool_calls = []
-        has_valid_tool_calls = False
-        
-        for msg in updated_messages:
-            if msg.get('role') == 'assistant' and 'tool_calls' in msg and msg['tool_calls']:
-                for tool_call in msg.get('tool_calls', []):
-                    function_info = tool_call.get('function', {})
-                    tool_info = {
-                        'name': function_info.get('name', ''),
-                        'arguments': function_info.get('arguments', '{}')
-                    }
+            plan_stats = None
+            
+            # Process the query asynchronously
+            async def process():
+                nonlocal plan_stats
+                # Tasks on the event loop thread do not see this thread's context
+                with activate(trace), span("agent_loop"):
+                    if mode == 'plan':
+                        response, messages, plan_stats = await planner_loop(query, mcp_tools, wallet_state, conversation_history or None)
+                        return response, messages
+                    return await agent_loop(query, mcp_tools, wallet_state, conversation_history or None)
+            
+            # Run the agent loop in the event loop once a slot is free
+            with admission.admit():
+                response, updated_messages = run_async_cancellable(process(), QUERY_TIMEOUT, request.environ)
+            
+            processing_time = time.time() - start_time
+            print(f"Query processed in {processing_time:.2f} seconds")
+            
+            # Update conversation history
+            with span("history.save", messages=len(updated_messages)):
+                state_store.save_history(session_id, updated_messages)
+            
+            # Get tool calls for display - only if they actually exist and are not empty
+            tool_calls = []
+            has_valid_tool_calls = False
+            
+            for msg in updated_messages:
+                if msg.get('role') == 'assistant' and 'tool_calls' in msg and msg['tool_calls']:
+                    for tool_call in msg.get('tool_calls', []):
+                        function_info = tool_call.get('function', {})
+                        tool_info = {
+                            'name': function_info.get('name', ''),
+                            'arguments': function_info.get('arguments', '{}')
+                        }
                     
-                    # Only add non-empty tool calls
-                    if tool_info['name']:
-                        has_valid_tool_calls = True
-                        tool_calls.append(tool_info)
-        
-        response_data = {
-            "response": response,
-            "processing_time": f"{processing_time:.2f}"
-        }
-        
-        # Only include tool_calls if there are actually valid ones
-        if has_valid_tool_calls:
-            response_data["tool_calls"] = tool_calls
-        
-        return jsonify(response_data)
-    except Exception as e:
-        print(f"Error processing query: {str(e)}")
-        traceback.print_exc()
-        return jsonify({"error": f"Error processing query: {str(e)}"}), 500
+                        # Only add non-empty tool calls
+                        if tool_info['name']:
+                            has_valid_tool_calls = True
+                            tool_calls.append(tool_info)
+            
+            response_data = {
+                "response": response,
+                "processing_time": f"{processing_time:.2f}",
+                "trace_id": trace.trace_id
+            }
+            
+            # Only include tool_calls if there are actually valid ones
+            if has_valid_tool_calls:
+                response_data["tool_calls"] = tool_calls
+            
+            if plan_stats:
+                response_data["plan"] = plan_stats
+            
+            return jsonify(response_data)
+        except AdmissionRejected as e:
+            print(f"Query rejected by admission control ({e.status_code}): {admission.stats()}")
+            resp = jsonify({"error": e.message, "trace_id": trace.trace_id})
+            resp.status_code = e.status_code
+            resp.headers["Retry-After"] = str(e.retry_after)
+            return resp
+        except TimeoutError as e:
+            print(f"Query cancelled: {str(e)}")
+            resp = jsonify({"error": str(e), "trace_id": trace.trace_id})
+            resp.status_code = 503
+            resp.headers["Retry-After"] = str(max(1, math.ceil(MAX_QUEUE_WAIT)))
+            return resp
+        except ConnectionAbortedError:
+            print("Client disconnected, query cancelled")
+            return jsonify({"error": "Client disconnected", "trace_id": trace.trace_id}), 499
+        except Exception as e:
+            print(f"Error processing query: {str(e)}")
+            traceback.print_exc()
+            return jsonify({"error": f"Error processing query: {str(e)}", "trace_id": trace.trace_id}), 500
+        finally:
+            trace.finish()
+            trace_buffer.add(trace)
+
+@app.route('/api/traces', methods=['GET'])
+def list_traces():
+    """API endpoint listing the most recent query traces of this worker"""
+    return jsonify({"traces": trace_buffer.recent(request.args.get('limit', 20, type=int))})
+
+@app.route('/api/traces/<trace_id>', methods=['GET'])
+def get_trace(trace_id):
+    """API endpoint returning the span waterfall of one query"""
+    trace = trace_buffer.get(trace_id)
+    if trace is None:
+        return jsonify({"error": "Trace not found"}), 404
+    return jsonify(trace.to_dict())
 
 @app.route('/api/reset', methods=['POST'])
 def reset_conversation():
-    global conversation_history
-    conversation_history = []
+    state_store.clear_history(get_session_id())
     return jsonify({"status": "success", "message": "Conversation reset successfully"})
 
-if __name__ == '__main__':
+def start_agent(state_path=None):
+    """Start this process's event loop, state store and MCP connection"""
+    global loop, state_store
+    state_store = create_state_store(state_path)
+    
     # Create a new event loop for async operations
     loop = asyncio.new_event_loop()
     
@@ -195,7 +398,64 @@ if __name__ == '__main__':
     t.start()
     
     # Initialize MCP client in the background loop
-    future = asyncio.run_coroutine_threadsafe(initialize_mcp_client(), loop)
+    return asyncio.run_coroutine_threadsafe(initialize_mcp_client(), loop)
+
+def run_worker(listen_fd, host, port, state_path):
+    """Entry point of a worker process serving requests on the shared listening socket"""
+    start_agent(state_path)
+    server = make_server(host, port, app, threaded=True, fd=listen_fd)
+    print(f"Worker {os.getpid()} serving on http://{host}:{port}")
+    server.serve_forever()
+
+def run_workers(workers, host, port, state_path):
+    """Pre-fork several workers that accept connections from one listening socket"""
+    if "fork" not in multiprocessing.get_all_start_methods():
+        print("Multi-worker mode needs fork support; falling back to a single worker")
+        start_agent(state_path)
+        app.run(debug=True, host=host, port=port, use_reloader=False)
+        return
+    
+    # Create the schema once before the workers open their own connections
+    create_state_store(state_path)
     
-    # Run Flask app in the main thread (don't wait for initialization to complete)
-    app.run(debug=True, host='0.0.0.0', port=5000, use_reloader=False)
\ No newline at end of file
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+    listener.set_inheritable(True)
+    
+    ctx = multiprocessing.get_context("fork")
+    processes = []
+    for _ in range(workers):
+        process = ctx.Process(target=run_worker, args=(listener.fileno(), host, port, state_path))
+        process.start()
+        processes.append(process)
+    print(f"Started {workers} workers on http://{host}:{port} sharing state in {state_path}")
+    
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("Shutting down workers...")
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="EVM DeFi Agent web server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("APP_WORKERS", "1")),
+                        help="Number of worker processes, each with its own MCP connection")
+    args = parser.parse_args()
+    
+    if args.workers > 1:
+        run_workers(args.workers, args.host, args.port, SHARED_STATE_PATH or DEFAULT_SHARED_STATE_PATH)
+    else:
+        # Initialize in the background (don't wait for initialization to complete)
+        start_agent(SHARED_STATE_PATH)
+        
+        # Run Flask app in the main thread
+        app.run(debug=True, host=args.host, port=args.port, use_reloader=False)
@@ -9,11 +9,14 @@ for managing Ethereum wallets and interacting with DeFi protocols.
 import os
 import sys
 import json
+import argparse
+import contextlib
 import asyncio
 import platform
 import time
 import traceback
-from typing import Dict, List, Any, Optional, Tuple
+from contextlib import asynccontextmanager
+from typing import Dict, List, Any, Optional, Tuple, Union
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -38,10 +41,38 @@ client = AsyncOpenAI(
 MODEL_ID = os.getenv("LLM_MODEL", "gpt-4")  # Use environment variable with fallback
 TOOL_CALL_TIMEOUT = 120  # 120 seconds timeout for tool calls
 INITIALIZATION_TIMEOUT = 30  # 30 seconds timeout for server initialization
+SIGNER_PING_INTERVAL = 15  # Seconds between signer health checks
+SIGNER_PING_TIMEOUT = 5  # Seconds before an unanswered health check counts as a failure
+SIGNER_MAX_BACKOFF = 30  # Upper bound for the delay between signer restart attempts
+SIGNER_CLOSE_TIMEOUT = 5  # Seconds to wait for the signer to exit before killing it
+SIGNER_RECOVERY_TIMEOUT = 60  # Seconds a tool call waits for a restarting signer
+MAX_SIGNER_RECONNECTS = 2  # Times an in-flight read call is re-run after a signer restart
+TOOL_CACHE_TTL = float(os.getenv("TOOL_CACHE_TTL", "10"))  # Seconds read-only tool results are reused
+PLANNER_MAX_STEPS = int(os.getenv("PLANNER_MAX_STEPS", "5"))  # LLM calls allowed per planned request
+
+# Tools that only read chain state and can safely be re-run after a reconnect
+READ_ONLY_TOOLS = {
+    "get-user-position",
+    "check-balance",
+    "get-lending-balance",
+    "get-borrow-balance",
+    "get-collateral-balance",
+}
+READ_ONLY_TOOL_PREFIXES = ("get-", "check-", "list-")
 
 # MCP imports
 from mcp import ClientSession, StdioServerParameters
+import mcp.types as types
 from mcp.client.stdio import stdio_client
+import anyio
+import anyio.lowlevel
+from anyio.streams.buffered import BufferedByteReceiveStream
+from mcp.shared.exceptions import McpError
+from signer_service import parse_address, MAX_MESSAGE_BYTES, SIGNER_RESTARTED_CODE, STATUS_METHOD
+
+# Tool result processing and request tracing
+from tool_results import process_tool_result
+from tracing import span
 
 # System prompt for the EVM DeFi agent
 SYSTEM_PROMPT = """You are an EVM DeFi agent that helps users manage their wallets and interact with DeFi protocols.
@@ -58,13 +89,118 @@ Available tools:
 Please assist the user with their wallet management and DeFi operations. Always use the active wallet address when making tool calls."""
 
 
+class SignerConnectionLost(Exception):
+    """Raised when the MCP signer connection drops while a request is in flight."""
+
+
+def is_signer_restart_error(error: McpError) -> bool:
+    """True for the error the signer service returns for requests aborted by a signer restart."""
+    # mcp passes the ErrorData as the exception argument rather than setting .error
+    data = getattr(error, "error", None) or (error.args[0] if error.args else None)
+    return getattr(data, "code", None) == SIGNER_RESTARTED_CODE
+
+
+def is_read_only_tool(tool_name: str) -> bool:
+    """Return True for tools that only read state and are safe to re-run."""
+    return tool_name in READ_ONLY_TOOLS or tool_name.startswith(READ_ONLY_TOOL_PREFIXES)
+
+
+async def run_cache_call(method, *args) -> Any:
+    """Run a tool cache call in a worker thread, since the SQLite store blocks while another
+    worker holds the write lock. Store errors are logged and treated as a cache miss."""
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, method, *args)
+    except Exception as e:
+        print(f"Tool cache {method.__name__} failed: {str(e)}")
+        return None
+
+
+class SignerServiceParameters:
+    """Address of a long-lived signer started with signer_service.py."""
+    def __init__(self, address: str):
+        self.address = address
+
+
+async def fetch_service_status(address: str, timeout: float = SIGNER_PING_TIMEOUT) -> dict:
+    """Ask a signer service for the restart and downtime counters of the signer behind it."""
+    kind, target = parse_address(address)
+
+    async def query():
+        if kind == "unix":
+            reader, writer = await asyncio.open_unix_connection(target)
+        else:
+            reader, writer = await asyncio.open_connection(*target)
+        try:
+            writer.write((json.dumps({"jsonrpc": "2.0", "id": 1, "method": STATUS_METHOD}) + "\n").encode())
+            await writer.drain()
+            response = json.loads(await reader.readline())
+        finally:
+            writer.close()
+        if "result" not in response:
+            raise RuntimeError(f"Signer service status request failed: {response.get('error')}")
+        return response["result"]
+
+    return await asyncio.wait_for(query(), timeout=timeout)
+
+
+@asynccontextmanager
+async def socket_client(address: str):
+    """Connect to a signer service and expose it as MCP read/write streams, like stdio_client."""
+    kind, target = parse_address(address)
+    if kind == "unix":
+        stream = await anyio.connect_unix(target)
+    else:
+        stream = await anyio.connect_tcp(*target)
+
+    read_stream_writer, read_stream = anyio.create_memory_object_stream(0)
+    write_stream, write_stream_reader = anyio.create_memory_object_stream(0)
+    buffered = BufferedByteReceiveStream(stream)
+
+    async def socket_reader():
+        try:
+            async with read_stream_writer:
+                while True:
+                    line = await buffered.receive_until(b"\n", MAX_MESSAGE_BYTES)
+                    try:
+                        message = types.JSONRPCMessage.model_validate_json(line)
+                    except Exception as exc:
+                        await read_stream_writer.send(exc)
+                        continue
+                    await read_stream_writer.send(message)
+        except (anyio.EndOfStream, anyio.IncompleteRead, anyio.ClosedResourceError, anyio.BrokenResourceError):
+            await anyio.lowlevel.checkpoint()
+
+    async def socket_writer():
+        try:
+            async with write_stream_reader:
+                async for message in write_stream_reader:
+                    json_message = message.model_dump_json(by_alias=True, exclude_none=True)
+                    await stream.send((json_message + "\n").encode())
+        except anyio.ClosedResourceError:
+            await anyio.lowlevel.checkpoint()
+
+    async with anyio.create_task_group() as tg, stream:
+        tg.start_soon(socket_reader)
+        tg.start_soon(socket_writer)
+        try:
+            yield read_stream, write_stream
+        finally:
+            tg.cancel_scope.cancel()
+
+
 class MCPClient:
     """A client class for interacting with the EVM signer MCP server."""
-    def __init__(self, server_params: StdioServerParameters):
+    def __init__(self, server_params: Union[StdioServerParameters, SignerServiceParameters]):
         self.server_params = server_params
         self.session = None
-        self._client = None
         self.tools = {}
+        self.supervisor = None
+        self.cache = None  # Optional shared store for read-only tool results
+        self.failed_since = None  # Time of the first failure the supervisor has not recovered from yet
+        self._owner_task = None
+        self._stop = None
+        self._ready = asyncio.Event()
+        self._lost = asyncio.Event()
 
     async def __aenter__(self):
         await self.connect()
@@ -72,38 +208,180 @@ class MCPClient:
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         try:
-            if self.session:
-                await self.session.__aexit__(exc_type, exc_val, exc_tb)
-        except Exception as e:
-            print(f"Error closing session: {str(e)}")
-            
-        try:
-            if self._client:
-                await self._client.__aexit__(exc_type, exc_val, exc_tb)
+            await self.close()
         except Exception as e:
             print(f"Error closing client: {str(e)}")
 
+    async def _own_connection(self, ready: asyncio.Future, stop: asyncio.Event):
+        """Owns the stdio process and session so both are entered and exited in one task"""
+        if isinstance(self.server_params, SignerServiceParameters):
+            transport = socket_client(self.server_params.address)
+        else:
+            transport = stdio_client(self.server_params)
+        try:
+            async with transport as (read, write):
+                print("DEBUG: Got read/write streams")
+                session_read_writer, session_read = anyio.create_memory_object_stream(0)
+
+                async def watch_transport(scope: anyio.CancelScope):
+                    # Forward messages to the session and notice as soon as the signer's output ends
+                    async with session_read_writer:
+                        async for message in read:
+                            await session_read_writer.send(message)
+                    if not stop.is_set():
+                        print("Signer connection closed")
+                        if not ready.done():
+                            ready.set_exception(SignerConnectionLost("Signer exited during initialization"))
+                        self.mark_lost()
+                        # Nothing more will arrive, so stop waiting on the session
+                        scope.cancel()
+
+                async with anyio.create_task_group() as tg:
+                    tg.start_soon(watch_transport, tg.cancel_scope)
+                    async with ClientSession(session_read, write) as session:
+                        print("DEBUG: Entered session")
+                        await session.initialize()
+                        self.session = session
+                        if not ready.done():
+                            ready.set_result(session)
+                        await stop.wait()
+                    tg.cancel_scope.cancel()
+        except BaseException as e:
+            if not ready.done():
+                ready.set_exception(e if isinstance(e, Exception) else RuntimeError("MCP connection cancelled"))
+            raise
+
+    def _on_connection_done(self, task: asyncio.Task):
+        """Called when the connection owner task exits, e.g. because the signer process died"""
+        error = None if task.cancelled() else task.exception()
+        if self._stop is not None and self._stop.is_set():
+            return
+        if error is not None:
+            print(f"MCP connection closed unexpectedly: {error}")
+        self.mark_lost()
+
     async def connect(self):
         """Establishes connection to MCP server"""
         print("Connecting to EVM signer MCP server...")
-        self._client = stdio_client(self.server_params)
-        print("DEBUG: Created stdio_client")
-        self.read, self.write = await self._client.__aenter__()
-        print("DEBUG: Got read/write streams")
-        session = ClientSession(self.read, self.write)
-        print("DEBUG: Created ClientSession")
-        self.session = await session.__aenter__()
-        print("DEBUG: Entered session")
-        
+        self._stop = asyncio.Event()
+        self._lost = asyncio.Event()
+        ready = asyncio.get_running_loop().create_future()
+        self._owner_task = asyncio.create_task(self._own_connection(ready, self._stop))
+        self._owner_task.add_done_callback(self._on_connection_done)
+
         try:
             print(f"DEBUG: Starting initialization with {INITIALIZATION_TIMEOUT}s timeout")
-            initialization_task = asyncio.create_task(self.session.initialize())
-            await asyncio.wait_for(initialization_task, timeout=INITIALIZATION_TIMEOUT)
+            await asyncio.wait_for(asyncio.shield(ready), timeout=INITIALIZATION_TIMEOUT)
             print("DEBUG: Initialized session")
-            print("MCP EVM Signer server running on stdio")
+            if isinstance(self.server_params, SignerServiceParameters):
+                print(f"Attached to EVM signer service at {self.server_params.address}")
+            else:
+                print("MCP EVM Signer server running on stdio")
+            self._ready.set()
         except asyncio.TimeoutError:
             print(f"ERROR: Timeout while initializing MCP server after {INITIALIZATION_TIMEOUT} seconds")
-            print("The server might be stuck. Some features may not work properly.")
+            await self.close()
+            raise TimeoutError(f"MCP server did not initialize within {INITIALIZATION_TIMEOUT} seconds")
+        except Exception:
+            await self.close()
+            raise
+
+    async def close(self):
+        """Shuts down the session and the signer process"""
+        self._ready.clear()
+        self.session = None
+        if self._stop is not None:
+            self._stop.set()
+        task, self._owner_task = self._owner_task, None
+        if task is None or task.done():
+            return
+        try:
+            # Cancelling after the grace period makes the stdio client kill the process
+            await asyncio.wait_for(task, timeout=SIGNER_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("DEBUG: Signer did not exit in time, process killed")
+        except Exception as e:
+            print(f"Error closing session: {str(e)}")
+
+    def mark_lost(self):
+        """Flags the current connection as dead and fails its in-flight requests"""
+        self._ready.clear()
+        self._lost.set()
+        self.note_failure()
+
+    def note_failure(self, at: Optional[float] = None):
+        """Records when the connection started failing and wakes the supervisor"""
+        at = at or time.time()
+        if self.failed_since is None or at < self.failed_since:
+            self.failed_since = at
+        if self.supervisor:
+            self.supervisor.request_check()
+
+    async def restart(self):
+        """Tears down the current connection and starts a fresh signer"""
+        self.mark_lost()
+        await self.close()
+        await self._remove_stale_container()
+        await self.connect()
+
+    async def _remove_stale_container(self):
+        """Removes a named signer container left behind by a killed docker client"""
+        if isinstance(self.server_params, SignerServiceParameters):
+            return
+        args = list(self.server_params.args or [])
+        if os.path.basename(self.server_params.command) != "docker" or "--name" not in args:
+            return
+        index = args.index("--name") + 1
+        if index >= len(args):
+            return
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                self.server_params.command, "rm", "-f", args[index],
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            await asyncio.wait_for(proc.wait(), timeout=SIGNER_CLOSE_TIMEOUT)
+        except Exception as e:
+            print(f"DEBUG: Could not remove stale container {args[index]}: {str(e)}")
+
+    async def wait_until_ready(self, timeout: Optional[float]) -> bool:
+        """Waits for a healthy connection, returning False if none is available in time"""
+        if self._ready.is_set():
+            return True
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def ping(self, timeout: float):
+        """Sends a lightweight health check request to the signer"""
+        session = self.session
+        if session is None:
+            raise SignerConnectionLost("Not connected to MCP server")
+        await self._request(session.send_ping(), timeout)
+
+    async def _request(self, coro, timeout: float):
+        """Awaits a session request, failing fast if the connection is lost meanwhile"""
+        lost = self._lost
+        started = time.time()
+        request_task = asyncio.create_task(coro)
+        lost_task = asyncio.create_task(lost.wait())
+        try:
+            done, _ = await asyncio.wait(
+                {request_task, lost_task}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if request_task in done:
+                return request_task.result()
+            if lost.is_set():
+                raise SignerConnectionLost("Signer connection lost")
+            # An unanswered request means the signer was already unresponsive when it was sent
+            self.note_failure(started)
+            raise asyncio.TimeoutError()
+        finally:
+            for task in (request_task, lost_task):
+                if not task.done():
+                    task.cancel()
 
     async def get_available_tools(self) -> Dict[str, Any]:
         """Retrieve available tools from the MCP server."""
@@ -159,30 +437,90 @@ class MCPClient:
         if not self.session:
             raise RuntimeError("Not connected to MCP server")
 
+        read_only = is_read_only_tool(tool_name)
+
         async def callable(*args, **kwargs):
+            with span(f"tool.{tool_name}", read_only=read_only) as tool_span:
+                cache = self.cache if TOOL_CACHE_TTL > 0 else None
+                if cache is None:
+                    return await call_signer(**kwargs)
+                
+                if not read_only:
+                    # A write may change any balance or position, so drop every cached read
+                    try:
+                        return await call_signer(**kwargs)
+                    finally:
+                        await run_cache_call(cache.cache_clear)
+                
+                cache_key = f"{tool_name}:{json.dumps(kwargs, sort_keys=True, default=str)}"
+                cached = await run_cache_call(cache.cache_get, cache_key)
+                if cached is not None:
+                    print(f"DEBUG: Using cached result for {tool_name}")
+                    tool_span.set(cache="hit")
+                    return types.CallToolResult.model_validate_json(cached)
+                
+                # A write that finishes while this read is in flight clears the cache; the
+                # generation check keeps the read from storing its possibly pre-write result
+                generation = await run_cache_call(cache.cache_generation)
+                response = await call_signer(**kwargs)
+                if generation is not None and isinstance(response, types.CallToolResult) and not response.isError:
+                    await run_cache_call(cache.cache_set, cache_key, response.model_dump_json(), TOOL_CACHE_TTL, generation)
+                return response
+
+        async def call_signer(**kwargs):
             max_retries = 3
             retry_delay = 5  # seconds
+            reconnects = 0
+            attempt = 0
             
-            for attempt in range(max_retries):
+            while attempt < max_retries:
+                # Wait for the supervisor instead of burning retries on a dead connection
+                if not await self.wait_until_ready(SIGNER_RECOVERY_TIMEOUT):
+                    return {"error": f"Signer unavailable, could not call {tool_name}"}
                 try:
                     print(f"DEBUG: Calling tool {tool_name} (attempt {attempt + 1}/{max_retries}) with args {kwargs}")
-                    tool_task = asyncio.create_task(self.session.call_tool(tool_name, arguments=kwargs))
                     
                     try:
-                        response = await asyncio.wait_for(tool_task, timeout=TOOL_CALL_TIMEOUT)
+                        with span("signer.request", attempt=attempt + 1, reconnects=reconnects):
+                            response = await self._request(
+                                self.session.call_tool(tool_name, arguments=kwargs), TOOL_CALL_TIMEOUT
+                            )
                         print(f"DEBUG: Got response from tool {tool_name}")
                         # Simply return the raw response without parsing
                         return response
+                    except McpError as e:
+                        # The signer service aborts in-flight requests when its signer dies
+                        if is_signer_restart_error(e):
+                            raise SignerConnectionLost(str(e)) from e
+                        raise
                     except asyncio.TimeoutError:
                         print(f"DEBUG: Timeout after {TOOL_CALL_TIMEOUT} seconds for {tool_name}")
-                        if attempt < max_retries - 1:
+                        if not read_only:
+                            # The signer may still complete the call, so sending it again could apply it twice
+                            return {"error": f"{tool_name} timed out after {TOOL_CALL_TIMEOUT} seconds; the operation may or may not have been applied"}
+                        attempt += 1
+                        if attempt < max_retries:
                             print(f"Retrying in {retry_delay} seconds...")
                             await asyncio.sleep(retry_delay)
                             continue
                         return {"error": f"Operation timed out after {max_retries} attempts"}
+                except SignerConnectionLost:
+                    print(f"DEBUG: Signer connection lost while calling {tool_name}")
+                    if read_only and reconnects < MAX_SIGNER_RECONNECTS:
+                        # Read calls are safe to re-run once the signer is back
+                        reconnects += 1
+                        continue
+                    return {"error": f"Signer connection lost while calling {tool_name}; the operation may or may not have been applied"}
                 except Exception as e:
                     print(f"Error calling {tool_name}: {str(e)}")
-                    if attempt < max_retries - 1:
+                    if self.supervisor:
+                        self.supervisor.request_check()
+                    if not read_only:
+                        # Only read-only tools are retried blindly; a write may already have been applied
+                        traceback.print_exc()
+                        return {"error": f"Error calling {tool_name}: {str(e)}; the operation was not retried"}
+                    attempt += 1
+                    if attempt < max_retries:
                         print(f"Retrying in {retry_delay} seconds...")
                         await asyncio.sleep(retry_delay)
                         continue
@@ -191,6 +529,146 @@ class MCPClient:
 
         return callable
 
+
+class MCPSupervisor:
+    """Keeps the MCP signer connection healthy, restarting the signer when it stops responding."""
+    def __init__(self, mcp_client: MCPClient, ping_interval: float = SIGNER_PING_INTERVAL,
+                 ping_timeout: float = SIGNER_PING_TIMEOUT, max_backoff: float = SIGNER_MAX_BACKOFF):
+        self.mcp_client = mcp_client
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.max_backoff = max_backoff
+        self.restarts = 0
+        self.failed_restarts = 0
+        self.total_downtime = 0.0
+        self.down_since = None
+        self.last_error = None
+        self.last_restart = None
+        self.service_status = None  # Counters of the signer behind a signer service, if one is used
+        self._wake = asyncio.Event()
+        self._task = None
+        mcp_client.supervisor = self
+
+    def start(self):
+        """Start the background health check task.
+
+        If the client is not connected yet, the task makes the first connection,
+        retrying with backoff until the signer answers.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background health check task."""
+        task, self._task = self._task, None
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def request_check(self):
+        """Ask for an immediate health check, e.g. after a failed call."""
+        self._wake.set()
+
+    async def _run(self):
+        if self.mcp_client.session is None:
+            await self._recover(initial=True)
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.ping_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+            try:
+                await self.mcp_client.ping(self.ping_timeout)
+                # A failed call that the signer has since answered around was not an outage
+                self.mcp_client.failed_since = None
+                await self._refresh_service_status()
+                continue
+            except Exception as e:
+                self.last_error = str(e) or type(e).__name__
+                print(f"Signer health check failed: {self.last_error}")
+
+            await self._recover()
+
+    async def _recover(self, initial: bool = False):
+        """Restart the signer with exponential backoff until it answers a ping.
+
+        With initial=True this makes the first connection; only failed attempts count as downtime.
+        """
+        if not initial:
+            # Downtime starts at the first failure, not when the health check noticed it
+            self.mcp_client.mark_lost()
+            self.down_since = self.mcp_client.failed_since or time.time()
+        backoff = 1.0
+        while True:
+            try:
+                if not initial:
+                    print("Restarting EVM signer MCP server...")
+                await self.mcp_client.restart()
+                await self.mcp_client.ping(self.ping_timeout)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.down_since is None:
+                    self.down_since = time.time()
+                self.failed_restarts += 1
+                self.last_error = str(e) or type(e).__name__
+                print(f"Signer {'connection' if initial else 'restart'} failed: {self.last_error}. "
+                      f"Retrying in {backoff:.0f} seconds...")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+        now = time.time()
+        if self.down_since is not None:
+            self.total_downtime += now - self.down_since
+        self.down_since = None
+        self.mcp_client.failed_since = None
+        if not initial:
+            self.restarts += 1
+            self.last_restart = now
+            print(f"Signer restarted ({self.restarts} restarts so far)")
+
+    async def _refresh_service_status(self):
+        """Fetch the counters of a signer service, whose own restarts this client never sees."""
+        server_params = self.mcp_client.server_params
+        if not isinstance(server_params, SignerServiceParameters):
+            return
+        try:
+            self.service_status = await fetch_service_status(server_params.address, self.ping_timeout)
+        except Exception as e:
+            print(f"DEBUG: Could not fetch signer service status: {str(e)}")
+
+    def stats(self) -> dict:
+        """Restart and downtime counters for status reporting.
+
+        With a signer service, restarts and downtime include the service's own
+        signer restarts, which are also listed separately under "service".
+        """
+        downtime = self.total_downtime
+        if self.down_since is not None:
+            downtime += time.time() - self.down_since
+        stats = {
+            "healthy": self.down_since is None and self.mcp_client.session is not None,
+            "restarts": self.restarts,
+            "failed_restarts": self.failed_restarts,
+            "downtime_seconds": round(downtime, 2),
+            "last_error": self.last_error,
+            "last_restart": datetime.fromtimestamp(self.last_restart).isoformat() if self.last_restart else None,
+        }
+        service = self.service_status
+        if service:
+            stats["healthy"] = stats["healthy"] and service["healthy"]
+            stats["restarts"] += service["restarts"]
+            stats["downtime_seconds"] = round(downtime + service["downtime_seconds"], 2)
+            stats["last_restart"] = max(filter(None, [stats["last_restart"], service["last_restart"]]), default=None)
+            stats["service"] = service
+        return stats
+
 async def get_wallet_state(mcp_client):
     """Get current wallet state."""
     return {
@@ -222,6 +700,19 @@ async def extract_tool_result(response, tool_name: str):
         print(f"Error extracting result: {e}")
         return response
 
+async def create_completion(stage: str, **kwargs):
+    """Call the chat completions API inside a trace span that records token usage."""
+    with span(stage, model=kwargs.get("model"), messages=len(kwargs.get("messages", []))) as completion_span:
+        response = await client.chat.completions.create(**kwargs)
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            completion_span.set(
+                prompt_tokens=getattr(usage, "prompt_tokens", None),
+                completion_tokens=getattr(usage, "completion_tokens", None),
+                total_tokens=getattr(usage, "total_tokens", None),
+            )
+        return response
+
 async def execute_tool_with_timeout(tool_callable, arguments, timeout=10):
     """Execute a tool with a timeout to prevent hanging."""
     try:
@@ -236,36 +727,69 @@ async def execute_tool_with_timeout(tool_callable, arguments, timeout=10):
     except Exception as e:
         return None, f"Error executing tool: {str(e)}"
 
-async def agent_loop(query: str, mcp_tools: dict, wallet_state: dict, messages: List[dict] = None):
+def prepare_tool_arguments(function_name: str, raw_arguments: str) -> dict:
+    """Parse the model's tool arguments and fill in the wallet defaults."""
+    try:
+        arguments = json.loads(raw_arguments)
+    except:
+        arguments = {}
+    if not isinstance(arguments, dict):
+        arguments = {}
+        
+    # Add default values if needed
+    if function_name in ["get-user-position", "check-balance", "get-lending-balance", 
+                          "get-borrow-balance", "get-collateral-balance"]:
+        if "address" not in arguments:
+            arguments["address"] = "0x95723432b6a145b658995881b0576d1e16850b02"
+    
+    # Always set network to monad-testnet
+    arguments["network"] = "monad-testnet"
+    return arguments
+
+def tool_timeout(function_name: str) -> int:
+    """Timeout in seconds for a single tool execution."""
+    if function_name == "get-user-position":
+        # Use a longer timeout for position data which might take longer
+        return 60  # Increased timeout for position data (was 30)
+    # Standard timeout for other tools
+    return 15
+
+async def agent_loop(query: str, mcp_tools: dict, wallet_state: dict, messages: List[dict] = None,
+                     status: dict = None):
     """
     Main agent loop with a clean flow:
     User Query -> LLM Tool Selection -> Tool Execution -> LLM Summary -> Response
+
+    Errors are answered with a fallback response; pass a status dict to have
+    the error recorded in status["error"] as well.
     """
     if messages is None:
         messages = []
 
     try:
-        # STEP 1: Initialize conversation if empty
-        if not messages:
-            # System message
-            messages.append({
-                "role": "system",
-                "content": (
-                    "You are a helpful DeFi assistant that can interact with EVM blockchains. "
-                    "Use the available tools to help users manage their finances and investments."
-                )
-            })
+        with span("history.prepare", messages=len(messages)):
+            # STEP 1: Initialize conversation if empty
+            if not messages:
+                # System message
+                messages.append({
+                    "role": "system",
+                    "content": (
+                        "You are a helpful DeFi assistant that can interact with EVM blockchains. "
+                        "Use the available tools to help users manage their finances and investments."
+                    )
+                })
 
-        # Create a copy of messages to work with
-        current_messages = messages.copy()
-        
-        # STEP 2: Add user query
-        current_messages.append({"role": "user", "content": query})
+            # Create a copy of messages to work with
+            current_messages = messages.copy()
+            
+            # STEP 2: Add user query
+            current_messages.append({"role": "user", "content": query})
         print(f"\nProcessing user query: {query}")
 
         # STEP 3: First LLM call - Ask LLM to select tools
         print("\nAsking LLM to select appropriate tools...")
-        first_response = await client.chat.completions.create(
+        first_response = await create_completion(
+            "llm.select_tools",
             model=MODEL_ID,
             messages=current_messages,
             tools=[tool["schema"] for tool in mcp_tools.values()],
@@ -313,20 +837,8 @@ async def agent_loop(query: str, mcp_tools: dict, wallet_state: dict, messages:
             function_name = tool_call.function.name
             print(f"\nProcessing tool call: {function_name}")
             
-            # Parse tool arguments
-            try:
-                arguments = json.loads(tool_call.function.arguments)
-            except:
-                arguments = {}
-                
-            # Add default values if needed
-            if function_name in ["get-user-position", "check-balance", "get-lending-balance", 
-                                  "get-borrow-balance", "get-collateral-balance"]:
-                if "address" not in arguments:
-                    arguments["address"] = "0x95723432b6a145b658995881b0576d1e16850b02"
-            
-            # Always set network to monad-testnet
-            arguments["network"] = "monad-testnet"
+            # Parse tool arguments and add defaults
+            arguments = prepare_tool_arguments(function_name, tool_call.function.arguments)
             
             print(f"Tool arguments: {json.dumps(arguments, indent=2)}")
             
@@ -338,20 +850,11 @@ async def agent_loop(query: str, mcp_tools: dict, wallet_state: dict, messages:
                 error_msg = None
                 
                 # Execute the tool with a timeout
-                if function_name == "get-user-position":
-                    # Use a longer timeout for position data which might take longer
-                    raw_result, error = await execute_tool_with_timeout(
-                        mcp_tools[function_name]["callable"], 
-                        arguments,
-                        timeout=60  # Increased timeout for position data (was 30)
-                    )
-                else:
-                    # Standard timeout for other tools
-                    raw_result, error = await execute_tool_with_timeout(
-                        mcp_tools[function_name]["callable"], 
-                        arguments,
-                        timeout=15
-                    )
+                raw_result, error = await execute_tool_with_timeout(
+                    mcp_tools[function_name]["callable"], 
+                    arguments,
+                    timeout=tool_timeout(function_name)
+                )
                 
                 execution_time = time.time() - start_time
                 print(f"Tool execution completed in {execution_time:.2f} seconds")
@@ -384,42 +887,12 @@ async def agent_loop(query: str, mcp_tools: dict, wallet_state: dict, messages:
                         tool_results.append({"tool": function_name, "error": error_msg})
                         continue
                     
-                    # --- REPLACED CODE BLOCK START ---
-                    # Handle the MCP response based on its known structure
+                    # Parse, project and cap the payload in a single pass
                     try:
-                        # The MCP response structure based on inspection:
-                        # { "content": [{"type": "text", "text": "JSON string"}], "isError": false }
-                        if hasattr(raw_result, 'content') and isinstance(raw_result.content, list):
-                            # This is the typical MCP response structure
-                            if raw_result.content and hasattr(raw_result.content[0], 'text'):
-                                tool_message_content = raw_result.content[0].text
-                            else:
-                                tool_message_content = str(raw_result.content)
-                        elif hasattr(raw_result, 'text'):
-                            # Direct text content
-                            tool_message_content = raw_result.text
-                        else:
-                            # Fallback for any other format
-                            try:
-                                tool_message_content = json.dumps(raw_result) if not isinstance(raw_result, str) else raw_result
-                            except:
-                                # Last resort - string representation
-                                tool_message_content = str(raw_result)
-                        
-                        # -- INSERTED NORMALIZATION SNIPPET START --
-                        # Normalize JSON to ensure it's clean and properly formatted for the API
-                        try:
-                            # If it's a JSON string, parse it and re-stringify to normalize
-                            json_obj = json.loads(tool_message_content)
-                            tool_message_content = json.dumps(json_obj, ensure_ascii=False)
-                        except:
-                            # If it's not valid JSON, leave it as is
-                            pass
-                        # -- INSERTED NORMALIZATION SNIPPET END --
-
-                        
-                        
-                        print(f"DEBUG: Sending MCP response to LLM: content={tool_message_content[:200] if len(str(tool_message_content)) > 200 else tool_message_content}...")
+                        tool_message_content, sizes = process_tool_result(function_name, raw_result)
+                        print(f"DEBUG: Tool result {sizes['bytes_in']} -> {sizes['bytes_out']} bytes"
+                              f"{' (truncated)' if sizes['truncated'] else ''}")
+                        print(f"DEBUG: Sending MCP response to LLM: content={tool_message_content[:200]}...")
                         
                         messages.append({
                             "role": "tool",
@@ -436,7 +909,6 @@ async def agent_loop(query: str, mcp_tools: dict, wallet_state: dict, messages:
                             "tool_call_id": tool_call.id,
                             "content": tool_message_content
                         })
-                    # --- REPLACED CODE BLOCK END ---
                     
                 except Exception as e:
                     error_msg = f"Error processing tool result: {str(e)}"
@@ -470,7 +942,8 @@ async def agent_loop(query: str, mcp_tools: dict, wallet_state: dict, messages:
         
         # Make the final API call
         try:
-            final_response = await client.chat.completions.create(
+            final_response = await create_completion(
+                "llm.summary",
                 model=MODEL_ID,
                 messages=messages,
             )
@@ -483,6 +956,8 @@ async def agent_loop(query: str, mcp_tools: dict, wallet_state: dict, messages:
             error_message = f"Error in final LLM call: {str(e)}"
             print(error_message)
             traceback.print_exc()
+            if status is not None:
+                status["error"] = error_message
             
             # Try with a simplified conversation if there was an error
             print("Trying with simplified conversation...")
@@ -504,6 +979,8 @@ async def agent_loop(query: str, mcp_tools: dict, wallet_state: dict, messages:
         error_message = f"Error in agent loop: {str(e)}"
         print(error_message)
         traceback.print_exc()
+        if status is not None:
+            status["error"] = error_message
         
         # Generate a simple fallback response
         fallback_response = "I encountered an error while processing your request. Please try again or rephrase your question."
@@ -512,15 +989,425 @@ async def agent_loop(query: str, mcp_tools: dict, wallet_state: dict, messages:
 
 
 
-async def main():
-    """Main function that sets up the MCP server and runs the interactive agent."""
+PLAN_TOOL_NAME = "run_tool_plan"
+
+# Pseudo-tool that lets the model submit several dependent tool calls in one step
+PLAN_TOOL_SCHEMA = {
+    "type": "function",
+    "function": {
+        "name": PLAN_TOOL_NAME,
+        "description": (
+            "Run several tool calls in one step. Steps whose depends_on lists are satisfied run "
+            "together in parallel waves; a step only starts after every step it depends on has finished. "
+            "Use depends_on for ordering (e.g. approve before supply). If an argument has to be computed "
+            "from another step's result, stop after that step and plan the rest in your next step."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "steps": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "string", "description": "Unique step id"},
+                            "tool": {"type": "string", "description": "Name of the tool to call"},
+                            "arguments": {"type": "object", "description": "Arguments for the tool"},
+                            "depends_on": {
+                                "type": "array",
+                                "items": {"type": "string"},
+                                "description": "Ids of steps that must finish first",
+                            },
+                        },
+                        "required": ["id", "tool"],
+                    },
+                }
+            },
+            "required": ["steps"],
+        },
+    },
+}
+
+PLANNER_INSTRUCTIONS = (
+    "You can work in several steps. In each step, request all tool calls that do not depend on each other "
+    "at once, or use run_tool_plan for calls with ordering dependencies. You will see the results before "
+    "your next step. When you have what you need, answer the user without calling tools."
+)
+
+async def run_tool_for_model(function_name: str, arguments: dict, mcp_tools: dict) -> str:
+    """Execute one tool and return the content of its tool message."""
+    if function_name not in mcp_tools:
+        return json.dumps({"error": f"Tool {function_name} not found"})
+    
+    start_time = time.time()
+    raw_result, error = await execute_tool_with_timeout(
+        mcp_tools[function_name]["callable"], arguments, timeout=tool_timeout(function_name)
+    )
+    print(f"Tool {function_name} completed in {time.time() - start_time:.2f} seconds")
+    
+    if error:
+        return json.dumps({"error": error})
+    if raw_result is None:
+        return json.dumps({"error": f"No response received from {function_name} tool"})
+    try:
+        content, _ = process_tool_result(function_name, raw_result)
+        return content
+    except Exception as e:
+        print(f"Error processing MCP result: {str(e)}")
+        return str(raw_result)
+
+async def run_wave(calls: List[Tuple[str, dict]], mcp_tools: dict,
+                   write_lock: Optional[asyncio.Lock] = None) -> List[str]:
+    """Execute one wave of independent tool calls and return their contents in order.
+
+    Read-only calls run concurrently. Calls that may send transactions run one after
+    another so they cannot race for the wallet's nonce; waves running at the same
+    time share a write_lock for the same reason.
+    """
+    results: List[Optional[str]] = [None] * len(calls)
+    write_lock = write_lock or asyncio.Lock()
+
+    async def run_reads():
+        indexes = [i for i, (name, _) in enumerate(calls) if is_read_only_tool(name)]
+        contents = await asyncio.gather(*(run_tool_for_model(calls[i][0], calls[i][1], mcp_tools) for i in indexes))
+        for i, content in zip(indexes, contents):
+            results[i] = content
+
+    async def run_writes():
+        for i, (name, arguments) in enumerate(calls):
+            if not is_read_only_tool(name):
+                async with write_lock:
+                    results[i] = await run_tool_for_model(name, arguments, mcp_tools)
+
+    await asyncio.gather(run_reads(), run_writes())
+    return results
+
+def plan_waves(steps: List[dict]) -> Tuple[List[List[dict]], Dict[str, str]]:
+    """Group plan steps into waves by dependency depth.
+
+    Returns the waves and an error message for every step whose dependencies
+    cannot be resolved. A single depends_on id is accepted in place of a list.
+    A plan with a missing, duplicate or tool-less step, or a depends_on that is
+    not a list of step ids, is rejected as a whole with ValueError, since later
+    steps cannot be matched to the step they were meant to depend on.
+    """
+    errors: Dict[str, str] = {}
+    by_id: Dict[str, dict] = {}
+    for position, step in enumerate(steps):
+        if not isinstance(step, dict):
+            raise ValueError(f"Step {position + 1} is not an object")
+        step_id = str(step.get("id", ""))
+        if not step_id:
+            raise ValueError(f"Step {position + 1} has no id")
+        if step_id in by_id:
+            raise ValueError(f"Duplicate step id {step_id}")
+        if not step.get("tool"):
+            raise ValueError(f"Step {step_id} has no tool")
+        depends_on = step.get("depends_on") or []
+        if isinstance(depends_on, str):
+            depends_on = [depends_on]
+        if not isinstance(depends_on, list) or not all(isinstance(dep, str) for dep in depends_on):
+            raise ValueError(f"Step {step_id} depends_on must be a list of step ids")
+        by_id[step_id] = dict(step, depends_on=depends_on)
+
+    waves: List[List[dict]] = []
+    done = set()
+    pending = dict(by_id)
+    while pending:
+        wave = [
+            step for step_id, step in pending.items()
+            if all(dep in done for dep in step["depends_on"])
+        ]
+        if not wave:
+            # Remaining steps depend on unknown steps or on each other
+            for step_id, step in pending.items():
+                missing = [dep for dep in step["depends_on"] if dep not in done]
+                errors[step_id] = f"Unresolvable dependencies: {', '.join(missing)}"
+            break
+        for step in wave:
+            del pending[str(step["id"])]
+            done.add(str(step["id"]))
+        waves.append(wave)
+    return waves, errors
+
+async def run_tool_plan(steps: List[dict], mcp_tools: dict, stats: dict,
+                        write_lock: Optional[asyncio.Lock] = None) -> dict:
+    """Execute a dependency graph of tool calls wave by wave."""
+    waves, errors = plan_waves(steps)
+    results: Dict[str, Any] = {step_id: {"error": error} for step_id, error in errors.items()}
+    failed = set(errors)
+
+    for wave in waves:
+        runnable, calls = [], []
+        for step in wave:
+            step_id = str(step["id"])
+            failed_deps = [dep for dep in step["depends_on"] if dep in failed]
+            if failed_deps:
+                results[step_id] = {"error": f"Skipped because {', '.join(failed_deps)} failed"}
+                failed.add(step_id)
+                continue
+            runnable.append(step_id)
+            calls.append((step["tool"], prepare_tool_arguments(step["tool"], json.dumps(step.get("arguments") or {}))))
+        if not calls:
+            continue
+
+        stats["waves"] += 1
+        stats["tool_calls"] += len(calls)
+        print(f"Plan wave {stats['waves']}: {', '.join(name for name, _ in calls)}")
+        for step_id, content in zip(runnable, await run_wave(calls, mcp_tools, write_lock)):
+            try:
+                results[step_id] = json.loads(content)
+            except ValueError:
+                results[step_id] = content
+            if isinstance(results[step_id], dict) and "error" in results[step_id]:
+                failed.add(step_id)
+    return results
+
+async def planner_loop(query: str, mcp_tools: dict, wallet_state: dict, messages: List[dict] = None,
+                       max_steps: int = PLANNER_MAX_STEPS, status: dict = None):
+    """
+    Iterative agent loop for multi-step requests:
+    User Query -> (LLM Step -> Parallel Tool Waves) x N -> LLM Summary -> Response
+
+    Returns the response, the updated messages and plan statistics
+    (LLM calls, tool calls, waves and wall time). Like agent_loop, errors
+    are recorded in the optional status dict.
+    """
+    start_time = time.time()
+    stats = {"steps": 0, "llm_calls": 0, "tool_calls": 0, "waves": 0}
+    if messages is None:
+        messages = []
+    history_length = len(messages)
+
+    try:
+        if not messages:
+            messages.append({
+                "role": "system",
+                "content": (
+                    "You are a helpful DeFi assistant that can interact with EVM blockchains. "
+                    "Use the available tools to help users manage their finances and investments."
+                )
+            })
+        messages.append({"role": "user", "content": query})
+        print(f"\nPlanning user query: {query}")
+
+        tools = [tool["schema"] for tool in mcp_tools.values()] + [PLAN_TOOL_SCHEMA]
+        final_content = None
+        for step in range(max_steps):
+            stats["steps"] += 1
+            request = {
+                "model": MODEL_ID,
+                "messages": [messages[0], {"role": "system", "content": PLANNER_INSTRUCTIONS}] + messages[1:],
+            }
+            # The last step has to produce the answer
+            if step < max_steps - 1:
+                request["tools"] = tools
+                request["tool_choice"] = "auto"
+            response = await create_completion(f"llm.step_{step + 1}", **request)
+            stats["llm_calls"] += 1
+
+            assistant_message = response.choices[0].message
+            if not getattr(assistant_message, "tool_calls", None):
+                final_content = assistant_message.content or ""
+                messages.append({"role": "assistant", "content": final_content})
+                break
+
+            messages.append({
+                "role": "assistant",
+                "content": assistant_message.content or "",
+                "tool_calls": [
+                    {
+                        "id": tool_call.id,
+                        "type": "function",
+                        "function": {"name": tool_call.function.name, "arguments": tool_call.function.arguments},
+                    }
+                    for tool_call in assistant_message.tool_calls
+                ],
+            })
+
+            # Direct tool calls in one step are independent of each other and of the step's
+            # plans, so they run as one wave alongside the plans' first waves
+            direct = [tc for tc in assistant_message.tool_calls if tc.function.name != PLAN_TOOL_NAME]
+            plans = [tc for tc in assistant_message.tool_calls if tc.function.name == PLAN_TOOL_NAME]
+            contents: Dict[str, str] = {}
+            write_lock = asyncio.Lock()
+
+            async def run_direct():
+                calls = [(tc.function.name, prepare_tool_arguments(tc.function.name, tc.function.arguments)) for tc in direct]
+                stats["waves"] += 1
+                stats["tool_calls"] += len(calls)
+                print(f"Step {step + 1} wave: {', '.join(name for name, _ in calls)}")
+                for tool_call, content in zip(direct, await run_wave(calls, mcp_tools, write_lock)):
+                    contents[tool_call.id] = content
+
+            async def run_plan(tool_call):
+                try:
+                    steps = json.loads(tool_call.function.arguments).get("steps") or []
+                    plan_results = await run_tool_plan(steps, mcp_tools, stats, write_lock)
+                    contents[tool_call.id] = json.dumps(plan_results, ensure_ascii=False, default=str)
+                except Exception as e:
+                    contents[tool_call.id] = json.dumps({"error": f"Invalid plan: {str(e)}"})
+
+            await asyncio.gather(*([run_direct()] if direct else []), *(run_plan(tc) for tc in plans))
+
+            for tool_call in assistant_message.tool_calls:
+                messages.append({"role": "tool", "tool_call_id": tool_call.id, "content": contents[tool_call.id]})
+
+        if final_content is None:
+            final_content = "I could not finish this request within the allowed number of steps."
+            messages.append({"role": "assistant", "content": final_content})
+            if status is not None:
+                status["error"] = f"No answer after {max_steps} steps"
+    except Exception as e:
+        print(f"Error in planner loop: {str(e)}")
+        traceback.print_exc()
+        if status is not None:
+            status["error"] = f"Error in planner loop: {str(e)}"
+        # Drop the partial turn so the history never holds unanswered tool calls
+        del messages[history_length:]
+        final_content = "I encountered an error while processing your request. Please try again or rephrase your question."
+
+    stats["wall_time"] = round(time.time() - start_time, 3)
+    print(f"Plan finished: {stats['llm_calls']} LLM calls, {stats['tool_calls']} tool calls "
+          f"in {stats['waves']} waves, {stats['wall_time']:.2f} seconds")
+    return final_content, messages, stats
+
+
+def tool_result_to_json(result: Any) -> Any:
+    """Convert a raw tool response into a JSON-serializable value."""
+    if hasattr(result, "model_dump"):
+        return result.model_dump(mode="json", exclude_none=True)
+    return result
+
+
+def parse_batch_line(line: str) -> dict:
+    """Turn one JSONL input line into a batch item with either a query or a tool call.
+
+    Accepted forms: {"id": ..., "query": "...", "mode": "plan"}, {"id": ..., "tool": "...", "args": {...}},
+    a JSON string, or plain text. Queries starting with "!tool " are direct tool calls.
+    """
+    try:
+        item = json.loads(line)
+    except json.JSONDecodeError:
+        item = line
+    if isinstance(item, str):
+        item = {"query": item}
+    if not isinstance(item, dict):
+        raise ValueError("Batch item must be an object, a string or plain text")
+    
+    query = item.get("query")
+    if isinstance(query, str) and query.startswith("!tool "):
+        parts = query[6:].split(" ", 1)
+        item = dict(item, tool=parts[0], args=json.loads(parts[1]) if len(parts) > 1 else {})
+        del item["query"]
+    
+    if not item.get("query") and not item.get("tool"):
+        raise ValueError("Batch item needs a 'query' or a 'tool'")
+    return item
+
+
+async def run_batch_item(index: int, line: str, mcp_tools: dict, mcp_client) -> dict:
+    """Run one batch item through agent_loop or a tool callable and return its output record."""
+    start_time = time.time()
+    record = {"index": index}
+    try:
+        item = parse_batch_line(line)
+        if "id" in item:
+            record["id"] = item["id"]
+        
+        if item.get("tool"):
+            tool_name = item["tool"]
+            record["tool"] = tool_name
+            if tool_name not in mcp_tools:
+                raise ValueError(f"Tool {tool_name} not found")
+            result = await mcp_tools[tool_name]["callable"](**(item.get("args") or {}))
+            record["result"] = tool_result_to_json(result)
+            record["ok"] = not (isinstance(result, dict) and "error" in result) and not getattr(result, "isError", False)
+        else:
+            record["query"] = item["query"]
+            wallet_state = await get_wallet_state(mcp_client)
+            status = {}
+            if item.get("mode") == "plan":
+                response, _, record["plan"] = await planner_loop(item["query"], mcp_tools, wallet_state, None,
+                                                                 status=status)
+            else:
+                response, _ = await agent_loop(item["query"], mcp_tools, wallet_state, None, status=status)
+            record["response"] = response
+            # The loops answer errors with a fallback response, which is not a successful item
+            record["ok"] = "error" not in status
+            if "error" in status:
+                record["error"] = status["error"]
+    except Exception as e:
+        record["ok"] = False
+        record["error"] = str(e)
+    record["elapsed"] = round(time.time() - start_time, 3)
+    return record
+
+
+async def run_batch(mcp_tools: dict, mcp_client, input_stream, output_stream, concurrency: int = 4) -> dict:
+    """Run every line of a JSONL input over the shared MCP connection, writing JSONL results.
+
+    Lines are read as they arrive and handed to `concurrency` workers through a
+    bounded queue, so input is never read far ahead of the work. Results are
+    written as they complete; each carries the input line index.
+    """
+    start_time = time.time()
+    concurrency = max(concurrency, 1)
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    summary = {"items": 0, "ok": 0, "failed": 0}
+    loop = asyncio.get_running_loop()
+
+    async def read_lines():
+        try:
+            index = 0
+            while True:
+                # readline blocks on pipes and terminals, so keep it off the event loop
+                line = await loop.run_in_executor(None, input_stream.readline)
+                if not line:
+                    break
+                line = line.strip()
+                if line:
+                    summary["items"] += 1
+                    await queue.put((index, line))
+                index += 1
+        finally:
+            for _ in range(concurrency):
+                await queue.put(None)
+
+    async def worker():
+        while True:
+            entry = await queue.get()
+            if entry is None:
+                return
+            record = await run_batch_item(entry[0], entry[1], mcp_tools, mcp_client)
+            summary["ok" if record["ok"] else "failed"] += 1
+            output_stream.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            output_stream.flush()
+
+    await asyncio.gather(read_lines(), *(worker() for _ in range(concurrency)))
+    
+    summary["elapsed"] = round(time.time() - start_time, 3)
+    print(f"Batch completed: {summary['items']} items, {summary['ok']} ok, "
+          f"{summary['failed']} failed in {summary['elapsed']:.2f} seconds")
+    return summary
+
+
+async def main(batch_input=None, batch_output=None, concurrency: int = 4) -> int:
+    """Main function that sets up the MCP server and runs the interactive agent.
+
+    When batch_input is given, its JSONL items are processed instead and the
+    results are written to batch_output.
+
+    Returns the process exit code: 1 if startup failed or any batch item failed.
+    """
     start_time = time.time()
     
     if platform.system() == 'Windows':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
     
-    # Configure EVM signer MCP server using Docker
-    server_params = StdioServerParameters(
+    # Attach to a running signer service if one is configured, otherwise start the signer using Docker
+    service_address = os.getenv("SIGNER_SERVICE_ADDRESS")
+    server_params = SignerServiceParameters(service_address) if service_address else StdioServerParameters(
         command="docker",
         args=[
             "run",
@@ -541,12 +1428,21 @@ async def main():
     try:
         print("Starting MCP client...")
         async with MCPClient(server_params) as mcp_client:
+            supervisor = MCPSupervisor(mcp_client)
+            supervisor.start()
+            
             # Get available tools
             print("Getting available tools...")
             mcp_tools = await mcp_client.get_available_tools()
             
             print(f"Loaded {len(mcp_tools)} tools from MCP server")
             
+            if batch_input is not None:
+                print(f"Startup completed in {time.time() - start_time:.2f} seconds")
+                summary = await run_batch(mcp_tools, mcp_client, batch_input, batch_output, concurrency)
+                await supervisor.stop()
+                return 1 if summary["failed"] else 0
+            
             # Welcome message
             print("\n" + "="*80)
             print("EVM DeFi Agent")
@@ -598,7 +1494,7 @@ async def main():
                             
                             if tool_name in mcp_tools:
                                 tool_result = await mcp_tools[tool_name]["callable"](**args)
-                                print(f"\nResult: {json.dumps(tool_result, indent=2)}\n")
+                                print(f"\nResult: {json.dumps(tool_result_to_json(tool_result), indent=2)}\n")
                             else:
                                 print(f"Tool {tool_name} not found")
                             continue
@@ -629,10 +1525,35 @@ async def main():
                 except Exception as e:
                     print(f"\nError: {str(e)}")
                     traceback.print_exc()
+            
+            await supervisor.stop()
+            return 0
 
     except Exception as e:
         print(f"Error in main execution: {str(e)}")
         traceback.print_exc()
+        return 1
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="EVM DeFi Agent")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="Run queries or !tool calls from a JSONL file ('-' for stdin) instead of the interactive prompt")
+    parser.add_argument("--output", metavar="FILE", help="Write batch results as JSONL to this file (default: stdout)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Batch items processed at once (default: 4)")
+    args = parser.parse_args()
+    
+    if args.batch:
+        batch_input = sys.stdin if args.batch == "-" else open(args.batch, "r", encoding="utf-8")
+        batch_output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+        try:
+            # Keep stdout clean for JSONL results; progress and debug output go to stderr
+            with contextlib.redirect_stdout(sys.stderr):
+                exit_code = asyncio.run(main(batch_input, batch_output, args.concurrency))
+        finally:
+            if batch_input is not sys.stdin:
+                batch_input.close()
+            if batch_output is not sys.stdout:
+                batch_output.close()
+        sys.exit(exit_code)
+    else:
+        sys.exit(asyncio.run(main()))
@@ -0,0 +1,149 @@
+"""
+Shared state for the EVM DeFi Agent web server
+
+Conversation sessions and cached tool results live here so that several app
+worker processes can serve the same users. The in-memory store is used for a
+single process; the SQLite store is shared by every worker on the machine.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class MemoryStateStore:
+    """Process-local state store used when running a single worker."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, List[dict]] = {}
+        self._cache: Dict[str, tuple] = {}
+        self._cache_generation = 0
+
+    def load_history(self, session_id: str) -> List[dict]:
+        with self._lock:
+            return list(self._sessions.get(session_id, []))
+
+    def save_history(self, session_id: str, messages: List[dict]):
+        with self._lock:
+            self._sessions[session_id] = list(messages)
+
+    def clear_history(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def cache_get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._cache[key]
+                return None
+            return value
+
+    def cache_generation(self) -> int:
+        with self._lock:
+            return self._cache_generation
+
+    def cache_set(self, key: str, value: str, ttl: float, generation: Optional[int] = None):
+        with self._lock:
+            if generation is not None and generation != self._cache_generation:
+                return  # The cache was cleared while the value was being fetched
+            self._cache[key] = (value, time.time() + ttl)
+
+    def cache_clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._cache_generation += 1
+
+
+class SQLiteStateStore:
+    """State store backed by a local SQLite file, shared between worker processes."""
+    def __init__(self, path: str, session_ttl: float = 7 * 24 * 3600):
+        self.path = path
+        self.session_ttl = session_ttl
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, messages TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tool_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            # Bumped on every clear so a read that started before a write cannot cache its stale result
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_state ("
+                "id INTEGER PRIMARY KEY CHECK (id = 0), generation INTEGER NOT NULL)"
+            )
+            conn.execute("INSERT OR IGNORE INTO cache_state (id, generation) VALUES (0, 0)")
+            conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - session_ttl,))
+            conn.execute("DELETE FROM tool_cache WHERE expires_at < ?", (time.time(),))
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections cannot be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load_history(self, session_id: str) -> List[dict]:
+        row = self._connection().execute(
+            "SELECT messages FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def save_history(self, session_id: str, messages: List[dict]):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO sessions (session_id, messages, updated_at) VALUES (?, ?, ?)",
+            (session_id, json.dumps(messages, ensure_ascii=False), time.time()),
+        )
+
+    def clear_history(self, session_id: str):
+        self._connection().execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def cache_get(self, key: str) -> Optional[str]:
+        row = self._connection().execute(
+            "SELECT value FROM tool_cache WHERE key = ? AND expires_at >= ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def cache_generation(self) -> int:
+        return self._connection().execute("SELECT generation FROM cache_state WHERE id = 0").fetchone()[0]
+
+    def cache_set(self, key: str, value: str, ttl: float, generation: Optional[int] = None):
+        if generation is None:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO tool_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl),
+            )
+            return
+        # Checked in the same statement, so a clear from another worker cannot slip in between
+        self._connection().execute(
+            "INSERT OR REPLACE INTO tool_cache (key, value, expires_at) "
+            "SELECT ?, ?, ? FROM cache_state WHERE id = 0 AND generation = ?",
+            (key, value, time.time() + ttl, generation),
+        )
+
+    def cache_clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM tool_cache")
+            conn.execute("UPDATE cache_state SET generation = generation + 1 WHERE id = 0")
+
+
+def create_state_store(path: Optional[str] = None):
+    """Return a SQLite store when a path is given, otherwise a process-local one."""
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        return SQLiteStateStore(path)
+    return MemoryStateStore()
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+EVM Signer Service
+
+Runs the EVM signer MCP server once as a long-lived local service so agent
+processes can attach to a warm signer in milliseconds instead of starting a
+new docker container each time. The signer still speaks MCP over stdio; this
+service exposes it on a Unix socket (or localhost TCP) using the same
+newline-delimited JSON-RPC framing and multiplexes every client connection
+over the one signer pipe by rewriting request ids.
+
+Usage:
+    python signer_service.py --listen unix:///tmp/evm-signer.sock
+    SIGNER_SERVICE_ADDRESS=unix:///tmp/evm-signer.sock python app.py
+"""
+
+import os
+import sys
+import json
+import asyncio
+import argparse
+import ipaddress
+import itertools
+import platform
+import time
+import traceback
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+DEFAULT_ADDRESS = "tcp://127.0.0.1:8765" if platform.system() == "Windows" else "unix:///tmp/evm-signer.sock"
+MAX_MESSAGE_BYTES = 16 * 1024 * 1024  # Largest JSON-RPC line accepted from the signer or a client
+RESPAWN_MAX_BACKOFF = 30  # Upper bound for the delay between signer restarts
+SIGNER_INITIALIZE_TIMEOUT = 30  # Seconds to wait for a respawned signer to initialize
+HEALTH_CHECK_INTERVAL = 15  # Seconds between pings to the signer
+HEALTH_CHECK_TIMEOUT = 30  # A signer that does not answer a ping within this is killed and respawned
+SIGNER_RESTARTED_CODE = -32001  # JSON-RPC error for requests aborted because the signer restarted
+STATUS_METHOD = "signer_service/status"  # Answered by the service itself with its restart counters
+
+
+def resolve_env_placeholders(args: List[Any]) -> List[Any]:
+    """Replace ${VAR} placeholders in server arguments with environment values."""
+    resolved_args = []
+    for arg in args:
+        if isinstance(arg, str) and "${" in arg:
+            # Simple environment variable substitution
+            for env_var in os.environ:
+                placeholder = "${" + env_var + "}"
+                if placeholder in arg:
+                    arg = arg.replace(placeholder, os.environ[env_var])
+        resolved_args.append(arg)
+    return resolved_args
+
+
+def parse_address(address: str) -> Tuple[str, Any]:
+    """Split a service address into ("unix", path) or ("tcp", (host, port))."""
+    if address.startswith("unix://"):
+        return "unix", address[len("unix://"):]
+    if address.startswith("tcp://"):
+        host, _, port = address[len("tcp://"):].rpartition(":")
+        return "tcp", (host or "127.0.0.1", int(port))
+    raise ValueError(f"Unsupported signer service address: {address} (use unix:///path or tcp://host:port)")
+
+
+def is_loopback_host(host: str) -> bool:
+    """True for localhost and loopback IP addresses."""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host.strip("[]")).is_loopback
+    except ValueError:
+        return False
+
+
+def _error_response(request_id: Any, message: str) -> dict:
+    return {"jsonrpc": "2.0", "id": request_id, "error": {"code": -32000, "message": message}}
+
+
+class SignerService:
+    """Owns one signer process and routes JSON-RPC traffic between it and many clients."""
+    def __init__(self, command: str, args: List[str], env: Optional[Dict[str, str]] = None):
+        self.command = command
+        self.args = args
+        self.env = env
+        self.process = None
+        self.restarts = 0
+        self.total_downtime = 0.0
+        self.down_since = None
+        self.last_restart = None
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, Callable[[dict], None]] = {}
+        self._init_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+        self._init_params = None
+        self._init_result = None
+        self._initialized_sent = False
+        self._ready = asyncio.Event()
+
+    async def _spawn(self):
+        env = dict(os.environ, **self.env) if self.env else None
+        self.process = await asyncio.create_subprocess_exec(
+            self.command, *self.args,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            env=env,
+            limit=MAX_MESSAGE_BYTES,
+        )
+        print(f"Signer started (pid {self.process.pid})")
+
+    async def _reinitialize(self):
+        """Replay the cached initialize handshake on a freshly spawned signer."""
+        if self._init_params is None:
+            return
+        await asyncio.wait_for(self._request("initialize", self._init_params), timeout=SIGNER_INITIALIZE_TIMEOUT)
+        if self._initialized_sent:
+            await self._send({"jsonrpc": "2.0", "method": "notifications/initialized"})
+
+    async def run_signer(self):
+        """Keep the signer running, respawning it with backoff whenever it exits."""
+        backoff = 1
+        while True:
+            reader = health = None
+            try:
+                await self._spawn()
+                reader = asyncio.create_task(self._read_signer())
+                await self._reinitialize()
+                self._ready.set()
+                if self.down_since is not None:
+                    self.last_restart = time.time()
+                    self.total_downtime += self.last_restart - self.down_since
+                    self.down_since = None
+                backoff = 1
+                health = asyncio.create_task(self._watch_health())
+                await reader
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Signer error: {str(e)}")
+            finally:
+                if reader and not reader.done():
+                    reader.cancel()
+                if health and not health.done():
+                    health.cancel()
+            self._ready.clear()
+            if self.down_since is None:
+                self.down_since = time.time()
+            self._fail_pending("Signer restarted, request aborted")
+            if self.process and self.process.returncode is None:
+                self.process.kill()
+            self.restarts += 1
+            print(f"Signer exited, restarting in {backoff} seconds ({self.restarts} restarts so far)")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, RESPAWN_MAX_BACKOFF)
+
+    async def _watch_health(self):
+        """Ping the signer periodically and kill it if it hangs, so run_signer respawns it."""
+        while True:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+            if not self._initialized_sent:
+                continue  # The signer rejects requests until a client has completed the handshake
+            started = time.time()
+            try:
+                await asyncio.wait_for(self._request("ping", {}), timeout=HEALTH_CHECK_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"Signer did not answer a ping within {HEALTH_CHECK_TIMEOUT} seconds, killing it")
+                # It was already unresponsive when the ping was sent
+                self.down_since = started
+                if self.process.returncode is None:
+                    self.process.kill()
+                return
+            except RuntimeError:
+                pass  # An error response still means the signer is responsive
+
+    def status(self) -> dict:
+        """Restart and downtime counters of the signer behind this service."""
+        downtime = self.total_downtime
+        if self.down_since is not None:
+            downtime += time.time() - self.down_since
+        return {
+            "healthy": self._ready.is_set() and self.down_since is None,
+            "restarts": self.restarts,
+            "downtime_seconds": round(downtime, 2),
+            "last_restart": datetime.fromtimestamp(self.last_restart).isoformat() if self.last_restart else None,
+        }
+
+    async def _read_signer(self):
+        while True:
+            line = await self.process.stdout.readline()
+            if not line:
+                return
+            try:
+                message = json.loads(line)
+            except ValueError:
+                print(f"Ignoring invalid signer output: {line[:200]!r}")
+                continue
+            if "id" in message and ("result" in message or "error" in message):
+                route = self._pending.pop(message["id"], None)
+                if route:
+                    route(message)
+            # Server notifications and server-to-client requests are not forwarded
+
+    def _fail_pending(self, reason: str):
+        pending, self._pending = self._pending, {}
+        for route in pending.values():
+            route({"jsonrpc": "2.0", "id": None, "error": {"code": SIGNER_RESTARTED_CODE, "message": reason}})
+
+    async def _send(self, message: dict):
+        async with self._write_lock:
+            self.process.stdin.write((json.dumps(message) + "\n").encode())
+            await self.process.stdin.drain()
+
+    async def _request(self, method: str, params: Any) -> dict:
+        """Send a request on behalf of the service itself and wait for the result."""
+        future = asyncio.get_running_loop().create_future()
+        bridge_id = next(self._ids)
+        self._pending[bridge_id] = lambda message: future.done() or future.set_result(message)
+        await self._send({"jsonrpc": "2.0", "id": bridge_id, "method": method, "params": params})
+        response = await future
+        if "error" in response:
+            raise RuntimeError(response["error"].get("message", "Signer request failed"))
+        return response["result"]
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve one agent connection until it disconnects."""
+        client_ids: Dict[Any, int] = {}  # Client request id -> bridge id, for cancellations
+        write_lock = asyncio.Lock()
+
+        async def reply(message: dict):
+            async with write_lock:
+                try:
+                    writer.write((json.dumps(message) + "\n").encode())
+                    await writer.drain()
+                except ConnectionError:
+                    pass  # Client went away; its response is dropped
+
+        def route_to_client(original_id):
+            def route(message: dict):
+                client_ids.pop(original_id, None)
+                message = dict(message, id=original_id)
+                asyncio.ensure_future(reply(message))
+            return route
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                method = message.get("method")
+                request_id = message.get("id")
+
+                if method == "initialize":
+                    await reply(await self._initialize(request_id, message.get("params")))
+                elif method == STATUS_METHOD:
+                    await reply({"jsonrpc": "2.0", "id": request_id, "result": self.status()})
+                elif method == "notifications/initialized":
+                    # The signer only needs to hear this once
+                    if not self._initialized_sent:
+                        self._initialized_sent = True
+                        await self._send(message)
+                elif method and request_id is not None:
+                    await self._ready.wait()
+                    bridge_id = next(self._ids)
+                    client_ids[request_id] = bridge_id
+                    self._pending[bridge_id] = route_to_client(request_id)
+                    await self._send(dict(message, id=bridge_id))
+                elif method == "notifications/cancelled":
+                    params = dict(message.get("params") or {})
+                    if params.get("requestId") in client_ids:
+                        params["requestId"] = client_ids.pop(params["requestId"])
+                        await self._send(dict(message, params=params))
+                elif method:
+                    await self._send(message)
+                # Responses to server-to-client requests are dropped; none are forwarded
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            print(f"Error serving client: {str(e)}")
+            traceback.print_exc()
+        finally:
+            # Late responses for this client are discarded
+            for bridge_id in client_ids.values():
+                self._pending.pop(bridge_id, None)
+            writer.close()
+
+    async def _initialize(self, request_id: Any, params: Any) -> dict:
+        """Answer a client's initialize, performing the real handshake only once."""
+        async with self._init_lock:
+            if self._init_result is None:
+                await self._ready.wait()
+                try:
+                    self._init_result = await self._request("initialize", params)
+                    self._init_params = params
+                except Exception as e:
+                    return _error_response(request_id, str(e))
+        return {"jsonrpc": "2.0", "id": request_id, "result": self._init_result}
+
+
+async def serve(address: str, command: str, args: List[str], env: Optional[Dict[str, str]] = None,
+                allow_remote: bool = False):
+    """Start the signer and accept agent connections on the given address.
+
+    TCP addresses must be loopback unless allow_remote is set, since any client
+    that can connect can sign with the wallet.
+    """
+    kind, target = parse_address(address)
+    if kind == "tcp" and not allow_remote and not is_loopback_host(target[0]):
+        raise ValueError(f"Refusing to listen on non-loopback address {address} (use --allow-remote to override)")
+
+    service = SignerService(command, args, env)
+    signer_task = asyncio.create_task(service.run_signer())
+
+    if kind == "unix":
+        if os.path.exists(target):
+            os.unlink(target)
+        # The socket gives full signing access, so create it private to this user
+        old_umask = os.umask(0o077)
+        try:
+            server = await asyncio.start_unix_server(service.handle_client, path=target, limit=MAX_MESSAGE_BYTES)
+        finally:
+            os.umask(old_umask)
+        os.chmod(target, 0o600)
+    else:
+        server = await asyncio.start_server(service.handle_client, *target, limit=MAX_MESSAGE_BYTES)
+    print(f"EVM signer service listening on {address}")
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        signer_task.cancel()
+        if service.process and service.process.returncode is None:
+            service.process.kill()
+        if kind == "unix" and os.path.exists(target):
+            os.unlink(target)
+
+
+def load_signer_command(config_path: str) -> Tuple[str, List[str], Optional[Dict[str, str]]]:
+    """Read the evm-signer command from mcp_config.json."""
+    with open(config_path, "r") as f:
+        config = json.load(f)
+    server_config = config["mcpServers"]["evm-signer"]
+    return server_config["command"], resolve_env_placeholders(server_config["args"]), server_config.get("env")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the EVM signer as a long-lived local service")
+    parser.add_argument("--listen", default=os.getenv("SIGNER_SERVICE_ADDRESS", DEFAULT_ADDRESS),
+                        help=f"unix:///path or tcp://127.0.0.1:port (default: {DEFAULT_ADDRESS})")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "mcp_config.json"),
+                        help="MCP config file with the evm-signer command")
+    parser.add_argument("--allow-remote", action="store_true",
+                        help="Allow listening on a non-loopback TCP address (anyone who can connect can sign)")
+    cli_args = parser.parse_args()
+
+    command, args, env = load_signer_command(cli_args.config)
+    try:
+        asyncio.run(serve(cli_args.listen, command, args, env, allow_remote=cli_args.allow_remote))
+    except KeyboardInterrupt:
+        print("Signer service stopped")
+        sys.exit(0)
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
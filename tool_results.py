@@ -0,0 +1,298 @@
+"""
+Tool result pipeline for the EVM DeFi Agent
+
+Turns a raw MCP tool response into the content of a "tool" message in one
+pass: the payload is parsed once, projected down to the fields the model
+needs and serialized once. Payloads that are still too large are capped with
+a summary so a single position dump cannot flood the prompt.
+"""
+
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library is used as fallback
+    orjson = None
+
+from tracing import span
+
+MAX_TOOL_RESULT_BYTES = int(os.getenv("MAX_TOOL_RESULT_BYTES", "16000"))  # Cap for a tool message
+SUMMARY_LIST_ITEMS = 5  # List items kept when a payload has to be summarized
+SUMMARY_STRING_CHARS = 200  # Characters kept per string when a payload has to be summarized
+
+# Keys that carry no information for the model in balance and position reads
+# (ABIs, bytecode, raw provider data). Applied per tool, so receipts keep their logs.
+NOISE_KEYS = {"abi", "bytecode", "deployedBytecode", "logsBloom", "logs", "provider", "raw"}
+
+# orjson parses integers outside the 64-bit range as floats, which would corrupt wei amounts
+_INT_OVERFLOW_MAX = float(2 ** 64)
+_INT_OVERFLOW_MIN = float(-2 ** 63)
+
+
+def _is_overflowed_int(value: float) -> bool:
+    return value >= _INT_OVERFLOW_MAX or value <= _INT_OVERFLOW_MIN
+
+
+def _has_overflowed_int(value: Any) -> bool:
+    # Iterative and only pushing containers, so the check stays cheap next to orjson itself
+    if type(value) is float:
+        return _is_overflowed_int(value)
+    if type(value) not in (dict, list):
+        return False
+    stack = [value]
+    while stack:
+        container = stack.pop()
+        for item in (container.values() if type(container) is dict else container):
+            kind = type(item)
+            if kind is float:
+                if _is_overflowed_int(item):
+                    return True
+            elif kind is dict or kind is list:
+                stack.append(item)
+    return False
+
+
+def loads(text: str) -> Any:
+    """Parse JSON with orjson when it is installed, re-parsing with json if orjson lost precision."""
+    if orjson is not None:
+        try:
+            value = orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # orjson also rejects integers too large for a double; json parses them exactly
+            return json.loads(text)
+        if not _has_overflowed_int(value):
+            return value
+    return json.loads(text)
+
+
+def dumps(value: Any) -> str:
+    """Serialize compact JSON with orjson when possible."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def _is_empty(value: Any) -> bool:
+    return value is None or value == "" or value == [] or value == {}
+
+
+def compact(value: Any) -> Any:
+    """Drop empty values anywhere in the payload."""
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            item = compact(item)
+            if not _is_empty(item):
+                result[key] = item
+        return result
+    if isinstance(value, list):
+        return [compact(item) for item in value if not _is_empty(item)]
+    return value
+
+
+def _is_zero(value: Any) -> bool:
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (int, float)):
+        return value == 0
+    if isinstance(value, str):
+        try:
+            return float(value) == 0
+        except ValueError:
+            return False
+    return False
+
+
+def _is_number(value: Any) -> bool:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return True
+    if isinstance(value, str):
+        try:
+            float(value)
+            return True
+        except ValueError:
+            return False
+    return False
+
+
+def _is_idle_entry(entry: Any) -> bool:
+    """True for a dict whose numeric fields are all zero, e.g. an unused market."""
+    if not isinstance(entry, dict):
+        return False
+    numbers = [v for v in entry.values() if _is_number(v)]
+    return bool(numbers) and all(_is_zero(v) for v in numbers)
+
+
+def drop_noise(value: Any) -> Any:
+    """Drop NOISE_KEYS anywhere in the payload."""
+    if isinstance(value, dict):
+        return {key: drop_noise(item) for key, item in value.items() if key not in NOISE_KEYS}
+    if isinstance(value, list):
+        return [drop_noise(item) for item in value]
+    return value
+
+
+def project_positions(value: Any) -> Any:
+    """Drop markets the wallet has no position in, keeping a count of what was removed."""
+    if isinstance(value, dict):
+        return {key: project_positions(item) for key, item in value.items()}
+    if isinstance(value, list):
+        kept = [project_positions(item) for item in value if not _is_idle_entry(item)]
+        omitted = len(value) - len(kept)
+        if not omitted:
+            return kept
+        marker = {"omitted_empty_entries": omitted}
+        # The marker is only worth adding when it is smaller than the entries it replaces
+        if len(dumps(marker)) >= len(dumps([item for item in value if _is_idle_entry(item)])):
+            return kept
+        if kept:
+            kept.append(marker)
+            return kept
+        return marker
+    return value
+
+
+def project_user_position(value: Any) -> Any:
+    return project_positions(drop_noise(value))
+
+
+# Per-tool projections applied after compact(); tools without one are only compacted
+TOOL_PROJECTIONS: Dict[str, Callable[[Any], Any]] = {
+    "get-user-position": project_user_position,
+    "check-balance": drop_noise,
+    "get-lending-balance": drop_noise,
+    "get-borrow-balance": drop_noise,
+    "get-collateral-balance": drop_noise,
+}
+
+
+def summarize(value: Any, list_items: int = SUMMARY_LIST_ITEMS, string_chars: int = SUMMARY_STRING_CHARS) -> Any:
+    """Shrink a payload by truncating long lists and strings."""
+    if isinstance(value, dict):
+        return {key: summarize(item, list_items, string_chars) for key, item in value.items()}
+    if isinstance(value, list):
+        head = [summarize(item, list_items, string_chars) for item in value[:list_items]]
+        if len(value) > list_items:
+            head.append(f"... {len(value) - list_items} more items")
+        return head
+    if isinstance(value, str) and len(value) > string_chars:
+        return value[:string_chars] + "..."
+    return value
+
+
+def cap(text: str, value: Any, max_bytes: int) -> str:
+    """Return text unchanged if it fits, otherwise a summary that does."""
+    original_bytes = len(text.encode("utf-8"))
+    if original_bytes <= max_bytes:
+        return text
+
+    if value is not None:
+        list_items, string_chars = SUMMARY_LIST_ITEMS, SUMMARY_STRING_CHARS
+        while list_items >= 1:
+            summary = dumps({
+                "truncated": True,
+                "original_bytes": original_bytes,
+                "summary": summarize(value, list_items, string_chars),
+            })
+            if len(summary.encode("utf-8")) <= max_bytes:
+                return summary
+            list_items //= 2
+            string_chars //= 2
+
+    preview = text.encode("utf-8")[:max(max_bytes - 100, 0)].decode("utf-8", errors="ignore")
+    return dumps({"truncated": True, "original_bytes": original_bytes, "preview": preview})
+
+
+class ToolResultStats:
+    """Running totals of payload bytes received from tools and sent to the model."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.results = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.truncated = 0
+
+    def record(self, bytes_in: int, bytes_out: int, truncated: bool):
+        with self._lock:
+            self.results += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.truncated += int(truncated)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "results": self.results,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "bytes_saved": self.bytes_in - self.bytes_out,
+                "truncated": self.truncated,
+                "json_backend": "orjson" if orjson is not None else "json",
+            }
+
+
+tool_result_stats = ToolResultStats()
+
+
+def _raw_payload(raw_result: Any) -> Tuple[Optional[str], Any]:
+    """Return (text, value) for a tool response; exactly one of them is set."""
+    # MCP CallToolResult: {"content": [{"type": "text", "text": "JSON string"}], "isError": false}
+    content = getattr(raw_result, "content", None)
+    if isinstance(content, list):
+        if content and hasattr(content[0], "text"):
+            return content[0].text, None
+        return str(content), None
+    if hasattr(raw_result, "text"):
+        return raw_result.text, None
+    if isinstance(raw_result, str):
+        return raw_result, None
+    # Already a Python object, e.g. an error dict from the tool callable
+    return None, raw_result
+
+
+def process_tool_result(tool_name: str, raw_result: Any, max_bytes: int = MAX_TOOL_RESULT_BYTES) -> Tuple[str, dict]:
+    """Convert a raw tool response into tool message content.
+
+    Returns the content string and the byte counts for this result.
+    """
+    with span("tool_result.process", tool=tool_name) as process_span:
+        content, sizes = _process_tool_result(tool_name, raw_result, max_bytes)
+        process_span.set(**sizes)
+        return content, sizes
+
+
+def _process_tool_result(tool_name: str, raw_result: Any, max_bytes: int) -> Tuple[str, dict]:
+    text, value = _raw_payload(raw_result)
+    if text is not None:
+        bytes_in = len(text.encode("utf-8"))
+        try:
+            value = loads(text)
+        except ValueError:
+            value = None
+    else:
+        # Measured before compaction so the stats include the bytes compact() drops
+        bytes_in = len(dumps(value).encode("utf-8")) if value is not None and not isinstance(value, str) else None
+
+    if value is not None and not isinstance(value, str):
+        value = compact(value)
+        projection = TOOL_PROJECTIONS.get(tool_name) or TOOL_PROJECTIONS.get(tool_name.replace("_", "-"))
+        if projection:
+            value = projection(value)
+        content = dumps(value)
+    else:
+        content = text if text is not None else str(value)
+
+    if bytes_in is None:
+        bytes_in = len(content.encode("utf-8"))
+
+    capped = cap(content, value if not isinstance(value, str) else None, max_bytes)
+    bytes_out = len(capped.encode("utf-8"))
+    truncated = capped is not content
+    tool_result_stats.record(bytes_in, bytes_out, truncated)
+    return capped, {"bytes_in": bytes_in, "bytes_out": bytes_out, "truncated": truncated}
@@ -0,0 +1,155 @@
+"""
+Request tracing for the EVM DeFi Agent
+
+Records a tree of timed spans for each query (LLM completions, tool calls and
+their retries, result processing, history handling) and keeps the most recent
+traces in a bounded in-memory ring buffer.
+
+The active span is held in a context variable, so code deep inside the agent
+can open child spans without passing the trace around. asyncio tasks inherit
+the context they were created in, which keeps concurrent tool calls attached
+to the right parent. When no trace is active, span() does nothing.
+"""
+
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import List, Optional
+
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))  # Number of recent traces kept in memory
+
+
+class Span:
+    """A timed operation within a trace."""
+    __slots__ = ("trace", "name", "start", "end", "attributes", "children")
+
+    def __init__(self, trace: "Trace", name: str, attributes: Optional[dict] = None):
+        self.trace = trace
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        self.attributes = dict(attributes or {})
+        self.children: List["Span"] = []
+
+    def set(self, **attributes):
+        """Attach attributes, e.g. token usage or byte counts."""
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        origin = self.trace.root.start
+        end = self.end if self.end is not None else time.perf_counter()
+        data = {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 2),
+            "end_ms": round((end - origin) * 1000, 2),
+            "duration_ms": round((end - self.start) * 1000, 2),
+        }
+        if self.attributes:
+            data["attributes"] = self.attributes
+        if self.children:
+            data["children"] = [child.to_dict() for child in sorted(self.children, key=lambda s: s.start)]
+        return data
+
+
+class _NullSpan:
+    """Stand-in returned by span() when no trace is active."""
+    def set(self, **attributes):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class Trace:
+    """The span tree of one request."""
+    def __init__(self, name: str, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.started_at = time.time()
+        self.root = Span(self, name, attributes)
+
+    def finish(self):
+        if self.root.end is None:
+            self.root.end = time.perf_counter()
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "started_at": datetime.fromtimestamp(self.started_at).isoformat(),
+            "duration_ms": self.root.to_dict()["duration_ms"],
+            "root": self.root.to_dict(),
+        }
+
+
+@contextmanager
+def activate(trace: Trace):
+    """Make the trace's root span current, e.g. inside a coroutine run on another thread."""
+    token = _current_span.set(trace.root)
+    try:
+        yield trace
+    finally:
+        _current_span.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time a block as a child of the current span."""
+    parent = _current_span.get()
+    if parent is None:
+        yield NULL_SPAN
+        return
+
+    child = Span(parent.trace, name, attributes)
+    parent.children.append(child)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.attributes["error"] = str(e) or type(e).__name__
+        raise
+    finally:
+        child.end = time.perf_counter()
+        _current_span.reset(token)
+
+
+class TraceBuffer:
+    """Bounded buffer of the most recent traces, looked up by id."""
+    def __init__(self, size: int = TRACE_BUFFER_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._traces: "OrderedDict[str, Trace]" = OrderedDict()
+
+    def add(self, trace: Trace):
+        with self._lock:
+            self._traces[trace.trace_id] = trace
+            while len(self._traces) > self.size:
+                self._traces.popitem(last=False)
+
+    def get(self, trace_id: str) -> Optional[Trace]:
+        with self._lock:
+            return self._traces.get(trace_id)
+
+    def recent(self, limit: int = 20) -> List[dict]:
+        """Summaries of the newest traces, newest first."""
+        # [-0:] would return every trace and a negative limit would cut from the wrong end
+        limit = max(1, limit)
+        with self._lock:
+            traces = list(self._traces.values())[-limit:]
+        return [
+            {
+                "trace_id": trace.trace_id,
+                "name": trace.root.name,
+                "started_at": datetime.fromtimestamp(trace.started_at).isoformat(),
+                "duration_ms": round(((trace.root.end or time.perf_counter()) - trace.root.start) * 1000, 2),
+            }
+            for trace in reversed(traces)
+        ]
+
+
+trace_buffer = TraceBuffer()